@@ -1,18 +1,72 @@
 #!/usr/bin/env python3
 
-from typing import Union, Optional
+from typing import Union, Optional, Iterable, Tuple
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+import itertools
+import multiprocessing
+import threading
 
 import numpy as np
+import numba
+import scipy.sparse
+import scipy.sparse.csgraph
+import scipy.spatial
 import skimage
 import trimesh
 from cloudvolume import CloudVolume
+from cloudvolume.lib import Bbox
 import cloudvolume.exceptions
 import cloudvolume.mesh
-import npimage
+
+
+# CloudVolumes opened from paths passed to the functions below, keyed by the
+# path and the arguments they were opened with
+_cloudvolume_cache = {}
+
+
+def _open_cloudvolume(cloudpath: str, **kwargs) -> CloudVolume:
+    """
+    Open a CloudVolume, or reuse the one opened by an earlier call with the
+    same arguments. This avoids re-downloading the volume's info file and
+    lets connections be reused when the same path is passed to these
+    functions over and over, e.g. in a loop.
+    """
+    key = (cloudpath, tuple(sorted(kwargs.items())))
+    if key not in _cloudvolume_cache:
+        _cloudvolume_cache[key] = CloudVolume(cloudpath, **kwargs)
+    return _cloudvolume_cache[key]
+
+
+def _forget_stale_cloudvolumes(vol: CloudVolume) -> None:
+    """
+    After vol's info has been changed, stop reusing any other cached
+    CloudVolumes for the same path, since their copies of the info are now
+    out of date.
+    """
+    for key, cached_vol in list(_cloudvolume_cache.items()):
+        if cached_vol is not vol and cached_vol.cloudpath == vol.cloudpath:
+            del _cloudvolume_cache[key]
+
+
+def _chunk_slices(start, stop, chunk_size) -> list:
+    """
+    Get a list of (x, y, z) slice tuples, one for each chunk in a grid of
+    chunks of size chunk_size that starts at start and covers everything up
+    to stop. The last chunk along each axis is clipped to stop.
+    """
+    starts = np.stack(np.meshgrid(
+        *[np.arange(a, b, c) for a, b, c in zip(start, stop, chunk_size)],
+        indexing='ij'
+    ), axis=-1).reshape(-1, 3)
+    stops = np.minimum(starts + np.asarray(chunk_size), stop)
+    return [tuple(slice(a, b) for a, b in zip(chunk_start, chunk_stop))
+            for chunk_start, chunk_stop in zip(starts.tolist(), stops.tolist())]
 
 
 def compress_raw_cloudvolume(source_path: str,
-                             target_path: Optional[str] = None):
+                             target_path: Optional[str] = None,
+                             n_threads: int = 32,
+                             task_queue: Optional[str] = None):
     """
     Make a copy of a raw (uncompressed or lossless compressed) cloudvolume
     that is jpeg compressed (lossily compressed).
@@ -28,8 +82,21 @@ def compress_raw_cloudvolume(source_path: str,
         cloudvolume will be saved in the same directory as the source
         cloudvolume, with the same name, but with the extension changed to
         ".jpeg.ng".
+
+    n_threads : int, default 32
+        The number of chunks to download concurrently, and separately the
+        number of chunks to encode and upload concurrently. Copying chunks is
+        dominated by network latency, so it's worth having many requests in
+        flight at once.
+
+    task_queue : str, optional
+        If provided, don't do the compression here. Instead, insert igneous
+        transfer tasks into the task queue at this path (e.g.
+        'fq://compression_tasks') so that they can be run by any number of
+        workers, in the same way that downsample.py's tasks are run. This
+        requires igneous to be installed.
     """
-    source = CloudVolume(source_path)
+    source = _open_cloudvolume(source_path)
     assert source.encoding == 'raw'
     if target_path is None:
         if source_path.endswith('.raw.ng'):
@@ -38,6 +105,24 @@ def compress_raw_cloudvolume(source_path: str,
             target_path = source_path.replace('.ng', '.jpeg.ng')
         else:
             target_path = source_path + '.jpeg.ng'
+
+    if task_queue is not None:
+        import igneous.task_creation as tc
+        from taskqueue import TaskQueue
+        tq = TaskQueue(task_queue)
+        tasks = tc.create_transfer_tasks(
+            source_path,
+            target_path,
+            chunk_size=source.chunk_size,
+            encoding='jpeg',
+            fill_missing=True,
+            skip_downsamples=True
+        )
+        tq.insert(tasks)
+        print(f'Done adding {len(tasks)} tasks compressing {source_path} to'
+              f' {target_path} to queue at {task_queue}')
+        return
+
     target_info = CloudVolume.create_new_info(
         num_channels=source.num_channels,
         layer_type='image',
@@ -53,39 +138,55 @@ def compress_raw_cloudvolume(source_path: str,
     target = CloudVolume(target_path, info=target_info)
     target.commit_info()
 
-    # Iterate through each chunk and upload it
-    for x in range(0, source.shape[0] - source.chunk_size[0], source.chunk_size[0]):
-        for y in range(0, source.shape[1] - source.chunk_size[1], source.chunk_size[1]):
-            for z in range(0, source.shape[2] - source.chunk_size[2], source.chunk_size[2]):
-                chunk = source[x:x+source.chunk_size[0],
-                               y:y+source.chunk_size[1],
-                               z:z+source.chunk_size[2]]
-                target[x:x+source.chunk_size[0],
-                       y:y+source.chunk_size[1],
-                       z:z+source.chunk_size[2]] = chunk
-
-    # Handle the last row/column/slice
-    for dim in range(3):
-        dim_size = source.shape[dim]
-        chunk_size = source.chunk_size[dim]
-        if dim_size % chunk_size != 0:
-            start = dim_size - (dim_size % chunk_size)
-            slices = [slice(None)] * 3
-            slices[dim] = slice(start, dim_size)
-            chunk = source[tuple(slices)]
-            target[tuple(slices)] = chunk
+    # Iterate through each chunk and upload it, many chunks at a time. The
+    # chunk grid starts at the volume's voxel offset (not at 0), which is
+    # what the target's chunks are aligned to, so every write covers whole
+    # target chunks and never has to download and patch an existing chunk.
+    chunks = _chunk_slices(source.bounds.minpt, source.bounds.maxpt,
+                           source.chunk_size)
+
+    # Downloading and uploading (which includes the jpeg encoding) are done by
+    # separate thread pools so that the network and the CPU are kept busy at
+    # the same time. The semaphore limits how many downloaded chunks can be
+    # waiting in memory for their upload.
+    chunks_in_memory = threading.BoundedSemaphore(2 * n_threads)
+    uploads = []
+
+    def upload_chunk(slices, download):
+        try:
+            target[slices] = download.result()
+        finally:
+            chunks_in_memory.release()
+
+    with ThreadPoolExecutor(max_workers=n_threads) as uploader:
+        with ThreadPoolExecutor(max_workers=n_threads) as downloader:
+            for slices in chunks:
+                chunks_in_memory.acquire()
+                download = downloader.submit(source.__getitem__, slices)
+                download.add_done_callback(
+                    lambda download, slices=slices: uploads.append(
+                        uploader.submit(upload_chunk, slices, download)))
+        # Consuming the results re-raises any exception from a worker thread
+        for upload in uploads:
+            upload.result()
 
 
 def downsample_cloudvolume(vol: Union[str, CloudVolume],
                            data: Optional[np.ndarray] = None,
                            compress: bool = True,
-                           return_downsampled_data: bool = False) -> Optional[np.ndarray]:
+                           return_downsampled_data: bool = False,
+                           n_workers: int = 1) -> Optional[np.ndarray]:
     """
     Downsample the image data in a cloudvolume by a factor of 2 in x, y, and z.
 
+    Image volumes are downsampled by averaging each 2x2x2 block of voxels.
+    Segmentation volumes are downsampled by taking the most common label in
+    each 2x2x2 block, since averaging labels would produce meaningless ones.
+
     If the data argument is left as None, the cloudvolume's data will be
     downloaded from the highest currently available mip (lowest resolution)
-    of the volume.
+    of the volume. It gets downloaded one slab at a time, so volumes much
+    larger than the available memory can be downsampled.
     If data is provided, it should be exactly equal to the data contained in
     the highest currently available mip of the volume, otherwise things will
     get weird.
@@ -96,30 +197,92 @@ def downsample_cloudvolume(vol: Union[str, CloudVolume],
     >>> data = vol[:]
     >>> for iteration in range(num_of_downsamplings):
     >>>     data = downsample_cloudvolume(vol, data=data, return_downsampled_data=True)
+
+    If data is not provided, n_workers > 1 splits the volume into slabs along
+    z that get downloaded, downsampled and uploaded by that many separate
+    processes, each of which opens its own connection to the cloudvolume.
+    The workers open it with the same settings (fill_missing, bounded,
+    secrets, cache, etc.) that vol has, so they behave the same way vol would.
+    The workers are started with multiprocessing's 'spawn' method, so a script
+    that calls this with n_workers > 1 needs an `if __name__ == '__main__':`
+    guard around its top-level code.
     """
-    original_mip = None
     if isinstance(vol, str):
-        vol = CloudVolume(vol, compress=compress)
-    elif hasattr(vol, 'mip'):
-        original_mip = vol.mip
+        vol = _open_cloudvolume(vol, compress=compress)
+        # A reused CloudVolume's info can be out of date, e.g. if another
+        # process has added scales since. The info gets edited and committed
+        # below, which would then delete those scales, so fetch it again.
+        vol.refresh_info()
+    original_mip = getattr(vol, 'mip', None)
     vol.mip = vol.available_mips[-1]
     print(f'Current mip: {vol.mip}')
     print(f'Will generate mip {vol.mip + 1} = scale {(2**(vol.mip+1),)*3}')
     try:
         vol.add_scale((2**(vol.mip+1),)*3, chunk_size=vol.chunk_size)
         vol.commit_info()
-        if data is None:
-            data = vol[:]
-        if not data.shape == vol.shape:
+        _forget_stale_cloudvolumes(vol)
+        if data is not None and not data.shape == vol.shape:
             raise ValueError(f'Expected data to have shape {vol.shape}, but'
                              f' it had shape {data.shape}.')
+        source_mip = vol.mip
+        source_bounds = vol.bounds
+        segmentation = vol.layer_type == 'segmentation'
 
-        data_downsampled = npimage.downsample(data, factor=2)
+        # Get the source data needed to make slab [z0:z1] of the new mip
+        def source_slab(z0, z1):
+            if data is not None:
+                return data[:, :, 2*z0:2*z1]
+            return _download_source_slab(vol, source_mip, source_bounds, z0, z1)
 
         vol.mip += 1
         assert vol.mip == vol.available_mips[-1]
-        assert vol.shape == data_downsampled.shape
-        vol[:] = data_downsampled
+        # These are computed from the info on every access, so look them up
+        # once instead of on every slab
+        shape = vol.shape
+        slab_thickness = vol.chunk_size[2]
+        z_offset = vol.voxel_offset[2]
+        if return_downsampled_data:
+            data_downsampled = np.empty(shape, dtype=vol.dtype, order='F')
+        # Downsample and upload one chunk-thick slab at a time. Each slab gets
+        # uploaded while it's still in cache, instead of building the whole
+        # downsampled volume and then reading it all back out for the upload.
+        slabs = [(z0, min(z0 + slab_thickness, shape[2]))
+                 for z0 in range(0, shape[2], slab_thickness)]
+        if n_workers > 1 and data is None:
+            # Use processes instead of threads so that the downsampling runs
+            # on multiple cores. Network connections can't be shared across
+            # processes, so each worker opens the cloudvolume itself.
+            # Workers are spawned rather than forked, since forking after
+            # numba's threading layer has started up (e.g. from an earlier
+            # downsampling in this process) leaves this process hanging at
+            # exit.
+            with ProcessPoolExecutor(max_workers=n_workers,
+                                     mp_context=multiprocessing.get_context('spawn'),
+                                     initializer=_open_worker_cloudvolume,
+                                     initargs=(vol.cloudpath,
+                                               _cloudvolume_settings(vol))) as executor:
+                futures = [executor.submit(_downsample_slab_in_worker, source_mip,
+                                           source_bounds, z0, z1, segmentation,
+                                           return_downsampled_data)
+                           for z0, z1 in slabs]
+                for (z0, z1), future in zip(slabs, futures):
+                    slab = future.result()
+                    if return_downsampled_data:
+                        data_downsampled[:, :, z0:z1] = slab
+        else:
+            with ThreadPoolExecutor(max_workers=1) as prefetcher:
+                # Fetch the source data for the next slab while the current
+                # slab is being downsampled and uploaded
+                next_source = prefetcher.submit(source_slab, *slabs[0])
+                for i, (z0, z1) in enumerate(slabs):
+                    source = next_source.result()
+                    if i + 1 < len(slabs):
+                        next_source = prefetcher.submit(source_slab, *slabs[i + 1])
+                    slab = downsample_array(source, segmentation=segmentation)
+                    assert slab.shape == (shape[0], shape[1], z1 - z0, shape[3])
+                    vol[:, :, z_offset+z0:z_offset+z1] = slab
+                    if return_downsampled_data:
+                        data_downsampled[:, :, z0:z1] = slab
     finally:
         if original_mip is not None:
             vol.mip = original_mip
@@ -128,10 +291,225 @@ def downsample_cloudvolume(vol: Union[str, CloudVolume],
         return data_downsampled
 
 
+def _download_source_slab(vol: CloudVolume,
+                          source_mip: int,
+                          source_bounds: Bbox,
+                          z0: int,
+                          z1: int) -> np.ndarray:
+    """
+    Download the part of mip source_mip that gets downsampled to make slab
+    [z0:z1] (counted from the start of the volume) of the next mip up.
+    Downloading one slab at a time instead of the whole source mip means only
+    a slab's worth of data is ever in memory at once.
+    """
+    bbox = Bbox(
+        (source_bounds.minpt[0], source_bounds.minpt[1],
+         source_bounds.minpt[2] + 2*z0),
+        (source_bounds.maxpt[0], source_bounds.maxpt[1],
+         min(source_bounds.minpt[2] + 2*z1, source_bounds.maxpt[2]))
+    )
+    # With parallel > 1, CloudVolume downloads through a process pool that
+    # installs signal handlers, which fails outside the main thread, and
+    # this gets called from a prefetch thread. Slabs span many chunks, so a
+    # single process still keeps the download busy.
+    # vol.mip has usually been moved on to the mip being made by now, and
+    # download() checks bbox against the bounds of vol.mip rather than of
+    # the mip it's given. Passing the source mip's own resolution as
+    # coord_resolution makes it check against the source mip's bounds.
+    return vol.download(bbox, mip=source_mip, parallel=1,
+                        coord_resolution=vol.meta.resolution(source_mip))
+
+
+# The CloudVolume opened by each of downsample_cloudvolume's worker processes
+_worker_vol = None
+
+
+def _cloudvolume_settings(vol: CloudVolume) -> dict:
+    """
+    Get the arguments that vol was opened with (other than its path, mip and
+    parallel), so that other processes can open a CloudVolume that behaves
+    the same way.
+    """
+    settings = {name: getattr(vol, name) for name in (
+        'fill_missing', 'bounded', 'autocrop', 'background_color',
+        'non_aligned_writes', 'delete_black_uploads', 'cdn_cache', 'compress',
+        'green_threads'
+    )}
+    settings['secrets'] = vol.config.secrets
+    # Passing this as cache= would put the cache in a subfolder of it, so
+    # it gets set on the new CloudVolume's cache after it's opened instead
+    settings['cache_path'] = vol.cache.path if vol.cache.enabled else None
+    return settings
+
+
+def _open_worker_cloudvolume(cloudpath: str, settings: dict) -> None:
+    global _worker_vol
+    settings = dict(settings)
+    cache_path = settings.pop('cache_path')
+    _worker_vol = CloudVolume(cloudpath, **settings)
+    if cache_path is not None:
+        _worker_vol.cache.path = cache_path
+        _worker_vol.cache.enabled = True
+
+
+def _downsample_slab_in_worker(source_mip: int,
+                               source_bounds: Bbox,
+                               z0: int,
+                               z1: int,
+                               segmentation: bool,
+                               return_slab: bool) -> Optional[np.ndarray]:
+    """
+    Make slab [z0:z1] of mip source_mip + 1 and upload it, using the worker
+    process's own CloudVolume.
+    """
+    source = _download_source_slab(_worker_vol, source_mip, source_bounds, z0, z1)
+    slab = downsample_array(source, segmentation=segmentation)
+    _worker_vol.mip = source_mip + 1
+    z_offset = _worker_vol.voxel_offset[2]
+    _worker_vol[:, :, z_offset+z0:z_offset+z1] = slab
+    if return_slab:
+        return slab
+
+
+def downsample_array(data: np.ndarray, segmentation: bool = False) -> np.ndarray:
+    """
+    Downsample an array by a factor of 2 along its first three axes by
+    averaging each 2x2x2 block of voxels. Any further axes (e.g. channels)
+    are left alone. This is what downsample_cloudvolume does to each mip.
+
+    Parameters
+    ----------
+    data : np.ndarray
+        The array to downsample, with at least 3 dimensions.
+    segmentation : bool, default False
+        If True, the most common value in each block is used instead of the
+        average, as is appropriate for segmentation labels.
+
+    Returns
+    -------
+    The downsampled array, with the same dtype as data. Axes with an odd
+    length are padded by repeating the last voxel, so the voxels on those
+    edges are the average of the voxels that do exist and the output has
+    ceil(length / 2) voxels along each axis.
+    """
+    if segmentation:
+        if data.dtype.kind not in 'ui':
+            raise TypeError('Segmentation data must have an integer dtype,'
+                            f' but it had dtype {data.dtype}.')
+        kernel = _mode_downsample2
+    elif data.dtype in _MEAN_DOWNSAMPLE2_DTYPES:
+        kernel = _mean_downsample2
+    else:
+        kernel = None
+    if kernel is not None:
+        out_shape = tuple((n + 1) // 2 for n in data.shape[:3]) + data.shape[3:]
+        out = np.empty(out_shape, dtype=data.dtype, order='F')
+        # The kernels expect a channel axis
+        kernel(data.reshape(data.shape[:3] + (-1,), order='A'),
+               out.reshape(out.shape[:3] + (-1,), order='A'))
+        return out
+
+    # For any other dtypes, use numpy
+    pad = [(0, n % 2) for n in data.shape[:3]] + [(0, 0)] * (data.ndim - 3)
+    if any(after for _, after in pad):
+        data = np.pad(data, pad, mode='edge')
+
+    # Sum the 8 voxels of each block in a dtype wide enough to not overflow
+    if data.dtype.kind in 'ui':
+        sum_dtype = np.dtype(f'{data.dtype.kind}{min(2 * data.dtype.itemsize, 8)}')
+    else:
+        sum_dtype = data.dtype
+    total = data[0::2, 0::2, 0::2].astype(sum_dtype)
+    for dx, dy, dz in list(itertools.product((0, 1), repeat=3))[1:]:
+        total += data[dx::2, dy::2, dz::2]
+
+    if data.dtype.kind in 'ui':
+        # Round to the nearest integer instead of always rounding down
+        total += 4
+        total //= 8
+    else:
+        total /= 8
+    return total.astype(data.dtype)
+
+
+@numba.njit(parallel=True, cache=True)
+def _mean_downsample2(data, out):
+    """
+    Fill the 4D (x, y, z, channel) integer array out with the average of
+    each 2x2x2 block of data, rounded to the nearest integer. Like the numpy
+    implementation, odd-length axes are treated as though their last voxel
+    were repeated.
+    """
+    nx, ny, nz = data.shape[0], data.shape[1], data.shape[2]
+    # Slabs are often only a few output z slices thick, so the work is split
+    # across threads by (y, z) row instead of by z slice alone
+    for yz in numba.prange(out.shape[1] * out.shape[2]):
+        y = yz % out.shape[1]
+        z = yz // out.shape[1]
+        ya = 2 * y
+        yb = min(ya + 1, ny - 1)
+        za = 2 * z
+        zb = min(za + 1, nz - 1)
+        for c in range(out.shape[3]):
+            # x varies fastest in CloudVolume's Fortran-ordered arrays,
+            # so it's the innermost loop
+            for x in range(out.shape[0]):
+                xa = 2 * x
+                xb = min(xa + 1, nx - 1)
+                total = (np.int64(data[xa, ya, za, c]) + data[xb, ya, za, c]
+                         + data[xa, yb, za, c] + data[xb, yb, za, c]
+                         + data[xa, ya, zb, c] + data[xb, ya, zb, c]
+                         + data[xa, yb, zb, c] + data[xb, yb, zb, c])
+                out[x, y, z, c] = (total + 4) // 8
+
+
+# The dtypes that get downsampled by a compiled kernel instead of by numpy.
+# These cover nearly all image data, and their sums fit in an int64. The
+# kernel gets compiled once per dtype and then cached on disk.
+_MEAN_DOWNSAMPLE2_DTYPES = frozenset(
+    np.dtype(dtype)
+    for dtype in (np.uint8, np.uint16, np.uint32, np.int8, np.int16, np.int32)
+)
+
+
+@numba.njit(parallel=True, cache=True)
+def _mode_downsample2(data, out):
+    """
+    Fill the 4D (x, y, z, channel) array out with the most common value in
+    each 2x2x2 block of data. Blocks on the edges of data with odd lengths
+    only have the voxels that exist considered.
+    """
+    for z in numba.prange(out.shape[2]):
+        values = np.empty(8, dtype=data.dtype)
+        for c in range(out.shape[3]):
+            for y in range(out.shape[1]):
+                for x in range(out.shape[0]):
+                    n = 0
+                    for zi in range(2 * z, min(2 * z + 2, data.shape[2])):
+                        for yi in range(2 * y, min(2 * y + 2, data.shape[1])):
+                            for xi in range(2 * x, min(2 * x + 2, data.shape[0])):
+                                values[n] = data[xi, yi, zi, c]
+                                n += 1
+                    # With at most 8 values, counting matches by brute force
+                    # is faster than anything fancier
+                    mode = values[0]
+                    mode_count = 0
+                    for i in range(n):
+                        count = 0
+                        for j in range(n):
+                            if values[j] == values[i]:
+                                count += 1
+                        if count > mode_count:
+                            mode = values[i]
+                            mode_count = count
+                    out[x, y, z, c] = mode
+
+
 def mesh_array(data: np.ndarray,
                threshold: float,
                discard_small_components: bool = False,
-               save_to_filename: Optional[str] = None) -> Union[trimesh.Trimesh, None]:
+               save_to_filename: Optional[str] = None,
+               backend: str = 'marching_cubes') -> Union[trimesh.Trimesh, None]:
     """
     Generate a mesh from a numpy array.
 
@@ -141,19 +519,31 @@ def mesh_array(data: np.ndarray,
         The array to mesh.
     threshold : float
         The threshold to use for the marching cubes algorithm.
+        With the marching cubes backend, or with float64 data, the data is
+        converted to float32 before meshing, so values that need more
+        precision than float32 has (e.g. integers above 2**24) will get
+        rounded.
     discard_small_components : bool, default False
         If True, only the single largest connected component of the mesh
         will be returned. Otherwise, the entire mesh will be returned.
     save_to_filename : str, optional
         If provided, the mesh will be saved to this file. Otherwise, the
         mesh will be returned.
+    backend : str, default 'marching_cubes'
+        The isosurface algorithm to use. 'marching_cubes' uses scikit-image's
+        marching cubes. 'flying_edges' uses VTK's flying edges algorithm,
+        which runs on multiple cores and is typically much faster on large
+        arrays, but requires vtk to be installed.
 
     Returns
     -------
     If save_to_filename is None, the mesh will be returned. Otherwise,
     saves the mesh to the provided filename and returns None.
     """
-    verts, faces, _, _ = skimage.measure.marching_cubes(data, threshold)
+    surface = _isosurface(data, threshold, backend)
+    if surface is None:
+        raise ValueError(f'No surface found at threshold {threshold}.')
+    verts, faces = surface
     mesh = trimesh.Trimesh(vertices=verts, faces=faces)
     if discard_small_components:
         components = mesh.split(only_watertight=False)
@@ -164,14 +554,113 @@ def mesh_array(data: np.ndarray,
         mesh.export(save_to_filename)
 
 
+def _isosurface(data: np.ndarray, threshold: float, backend: str):
+    """
+    Compute an isosurface of a 3D array with the given backend (see
+    mesh_array). Returns (verts, faces), or None if the array contains no
+    surface at the threshold.
+    """
+    # Skip meshing the parts of the array that can't contain any surface
+    crop = _crop_to_surface(data, threshold)
+    if crop is None:
+        return None
+    data = data[crop]
+    # skimage's marching cubes makes its own C-ordered float32 copy of the
+    # data, so leave the conversion to it. VTK meshes whatever dtype it's
+    # given, so halve the memory it works through by giving it float32
+    # instead of float64. It handles integer data natively.
+    if backend == 'flying_edges' and data.dtype == np.float64:
+        data = data.astype(np.float32)
+    if backend == 'marching_cubes':
+        try:
+            verts, faces, _, _ = skimage.measure.marching_cubes(data, threshold)
+        except RuntimeError:
+            # skimage counts voxels equal to the threshold as below it, so
+            # the crop can leave data that skimage finds no surface in
+            return None
+    elif backend == 'flying_edges':
+        verts, faces = _flying_edges(data, threshold)
+    else:
+        raise ValueError("backend must be 'marching_cubes' or 'flying_edges'"
+                         f" but was {backend!r}")
+    if len(faces) == 0:
+        return None
+    verts = verts + [axis_slice.start for axis_slice in crop]
+    return verts, faces
+
+
+def _crop_to_surface(data: np.ndarray, threshold: float) -> Optional[tuple]:
+    """
+    Find the smallest box within data that contains every cube of 8 voxels
+    that has corners on both sides of the threshold. Those are the only cubes
+    that an isosurface can pass through, so everything outside this box can be
+    skipped when meshing. This is cheap compared to meshing, and on sparse
+    volumes it usually excludes most of the array.
+
+    Returns a tuple of slices, or None if data contains no surface at all.
+    """
+    at_or_above = data >= threshold
+    at_or_below = data <= threshold
+    crop = []
+    for axis in range(3):
+        other_axes = tuple(other for other in range(3) if other != axis)
+        start, stop = 0, data.shape[axis]
+        for mask in (at_or_above, at_or_below):
+            present = np.flatnonzero(mask.any(axis=other_axes))
+            if len(present) == 0:
+                return None
+            # Pad by one voxel to include the cubes on either side
+            start = max(start, present[0] - 1)
+            stop = min(stop, present[-1] + 2)
+        crop.append(slice(start, stop))
+    return tuple(crop)
+
+
+def _flying_edges(data: np.ndarray, threshold: float):
+    """
+    Compute an isosurface of a 3D array using VTK's flying edges algorithm.
+    Returns (verts, faces) in the same format as skimage's marching cubes.
+    """
+    import vtk
+    from vtk.util.numpy_support import numpy_to_vtk, vtk_to_numpy
+
+    image = vtk.vtkImageData()
+    image.SetDimensions(*data.shape)
+    # VTK image data is stored with x varying fastest, i.e. Fortran order
+    image.GetPointData().SetScalars(
+        numpy_to_vtk(np.ravel(data, order='F'), deep=True)
+    )
+    flying_edges = vtk.vtkFlyingEdges3D()
+    flying_edges.SetInputData(image)
+    flying_edges.SetValue(0, threshold)
+    flying_edges.ComputeNormalsOff()
+    flying_edges.ComputeGradientsOff()
+    flying_edges.ComputeScalarsOff()
+    flying_edges.Update()
+
+    polydata = flying_edges.GetOutput()
+    if polydata.GetNumberOfPoints() == 0:
+        return np.zeros((0, 3)), np.zeros((0, 3), dtype=int)
+    verts = vtk_to_numpy(polydata.GetPoints().GetData())
+    # Each polygon is stored as [3, vertex_a, vertex_b, vertex_c]
+    faces = vtk_to_numpy(polydata.GetPolys().GetData()).reshape(-1, 4)[:, 1:]
+    return verts, faces
+
+
 def mesh_cloudvolume(vol: Union[str, CloudVolume],
                      threshold: float,
                      mip: Optional[int] = None,
                      discard_small_components: bool = False,
-                     save_to_filename: Optional[str] = None) -> Union[trimesh.Trimesh, None]:
+                     save_to_filename: Optional[str] = None,
+                     backend: str = 'marching_cubes',
+                     tile_size: int = 256,
+                     n_threads: int = 8) -> Union[trimesh.Trimesh, None]:
     """
     Generate a mesh from a cloudvolume.
 
+    The volume is downloaded and meshed in cube-shaped tiles, so the whole
+    volume never needs to fit in memory at once.
+
     Parameters
     ----------
     vol : CloudVolume or str
@@ -188,26 +677,72 @@ def mesh_cloudvolume(vol: Union[str, CloudVolume],
     save_to_filename : str, optional
         If provided, the mesh will be saved to this file. Otherwise, the
         mesh will be returned.
+    backend : str, default 'marching_cubes'
+        The isosurface algorithm to use. 'marching_cubes' uses scikit-image's
+        marching cubes. 'flying_edges' uses VTK's flying edges algorithm,
+        which runs on multiple cores and is typically much faster on large
+        arrays, but requires vtk to be installed.
+    tile_size : int, default 256
+        The edge length, in voxels, of the tiles that are meshed one at a
+        time. Peak memory usage is proportional to tile_size**3 * n_threads.
+    n_threads : int, default 8
+        The number of tiles to download and mesh concurrently.
 
     Returns
     -------
     If save_to_filename is None, the mesh will be returned. Otherwise,
     saves the mesh to the provided filename and returns None.
     """
-    original_mip = None
     if isinstance(vol, str):
-        vol = CloudVolume(vol)
-    elif hasattr(vol, 'mip'):
-        original_mip = vol.mip
+        vol = _open_cloudvolume(vol)
+    original_mip = getattr(vol, 'mip', None)
     if mip is None:
         mip = vol.available_mips[-1]
     vol.mip = mip
     try:
-        data = np.array(vol[:].squeeze())
-        mesh = mesh_array(data, threshold,
-                          discard_small_components=discard_small_components,
-                          save_to_filename=save_to_filename)
+        bounds = vol.bounds
+
+        def mesh_tile(start):
+            # Tiles overlap by one voxel so that the cubes spanning the
+            # boundary between two neighboring tiles get meshed
+            stop = np.minimum(start + tile_size + 1, bounds.maxpt)
+            if any(stop - start < 2):
+                return None
+            # Tiles are downloaded from several threads at once, so don't let
+            # CloudVolume start a process pool of its own (which only works
+            # from the main thread) even if vol.parallel > 1.
+            # Take a view of the first channel instead of copying the
+            # downloaded array. Meshing only crops it, which is also a
+            # view, and leaves any copying to the meshing backend.
+            data = vol.download(Bbox(start, stop), mip=mip, parallel=1)[..., 0]
+            # Tiles entirely above or below the threshold contain no surface.
+            # Voxels equal to the threshold count as below it.
+            if data.min() > threshold or data.max() <= threshold:
+                return None
+            surface = _isosurface(data, threshold, backend)
+            if surface is None:
+                return None
+            verts, faces = surface
+            return trimesh.Trimesh(vertices=verts + (start - bounds.minpt),
+                                   faces=faces)
+
+        tile_starts = [np.array(start) for start in itertools.product(
+            *[range(lo, hi, tile_size) for lo, hi in zip(bounds.minpt, bounds.maxpt)]
+        )]
+        with ThreadPoolExecutor(max_workers=n_threads) as executor:
+            tile_meshes = [tile_mesh for tile_mesh in executor.map(mesh_tile, tile_starts)
+                           if tile_mesh is not None]
+        if not tile_meshes:
+            raise ValueError(f'No surface found at threshold {threshold}.')
+        # Vertices on the boundaries between tiles were generated once by
+        # each neighboring tile, so merge them back together
+        mesh = _merge_seam_vertices(trimesh.util.concatenate(tile_meshes),
+                                    tile_size)
+        if discard_small_components:
+            components = mesh.split(only_watertight=False)
+            mesh = max(components, key=lambda component: len(component.faces))
         if save_to_filename is not None:
+            mesh.export(save_to_filename)
             return save_to_filename
         # Scale vertex coordinates to use physical units (usually nanometers)
         mesh.vertices = mesh.vertices * vol.resolution
@@ -218,6 +753,43 @@ def mesh_cloudvolume(vol: Union[str, CloudVolume],
     return mesh
 
 
+def _merge_seam_vertices(mesh: trimesh.Trimesh,
+                         tile_size: int,
+                         tolerance: float = 1e-3) -> trimesh.Trimesh:
+    """
+    Merge together the copies of each vertex that neighboring tiles of
+    mesh_cloudvolume generated on the planes between them. The vertex
+    coordinates must be relative to the corner of the first tile.
+
+    Each tile computes its vertices in float32 relative to its own (cropped)
+    corner, so the two copies of a seam vertex can differ by ~1e-5 voxels.
+    That's too far apart for trimesh's merge_vertices, and rounding the
+    vertices would still split copies that fall on either side of a rounding
+    boundary, so copies within tolerance voxels of each other get merged.
+    """
+    vertices = mesh.vertices
+    # The coordinate across a seam is an integer, which float32 represents
+    # exactly, so seam vertices can be found exactly
+    on_seam = np.zeros(len(vertices), dtype=bool)
+    for axis in range(3):
+        on_seam |= (vertices[:, axis] > 0) & (vertices[:, axis] % tile_size == 0)
+    seam = np.flatnonzero(on_seam)
+    pairs = scipy.spatial.cKDTree(vertices[seam]).query_pairs(
+        tolerance, output_type='ndarray')
+    # Group together every set of vertices connected by close pairs
+    close = scipy.sparse.coo_matrix(
+        (np.ones(len(pairs)), (seam[pairs[:, 0]], seam[pairs[:, 1]])),
+        shape=(len(vertices), len(vertices))
+    )
+    _, group = scipy.sparse.csgraph.connected_components(close, directed=False)
+    _, first_in_group = np.unique(group, return_index=True)
+    faces = group[mesh.faces]
+    # Drop any tiny faces that merging collapsed
+    keep = ((faces[:, 0] != faces[:, 1]) & (faces[:, 1] != faces[:, 2])
+            & (faces[:, 2] != faces[:, 0]))
+    return trimesh.Trimesh(vertices=vertices[first_in_group], faces=faces[keep])
+
+
 def push_mesh(mesh: Union[str, trimesh.Trimesh, cloudvolume.mesh.Mesh],
               mesh_id: int,
               vol: Union[str, CloudVolume],
@@ -258,17 +830,46 @@ def push_mesh(mesh: Union[str, trimesh.Trimesh, cloudvolume.mesh.Mesh],
 
     compress : bool, default True
         Whether or not to gzip the mesh file, reducing disk usage and network
-        bandwidth at the cost of a small amount of compute time.
+        bandwidth at the cost of a small amount of compute time. Meshes are
+        uploaded in neuroglancer's legacy precomputed format, which stores
+        raw vertex and face arrays (not Draco-compressed ones), so gzipping
+        them is generally worthwhile.
 
     overwrite : bool, default False
         Whether or not to overwrite an existing mesh with the same mesh_id.
     """
+    push_meshes([(mesh, mesh_id)], vol, scale_by=scale_by,
+                compress=compress, overwrite=overwrite)
+
+
+def push_meshes(meshes_and_ids: Iterable[Tuple[Union[str, trimesh.Trimesh, cloudvolume.mesh.Mesh], int]],
+                vol: Union[str, CloudVolume],
+                scale_by: float = 1,
+                compress: bool = True,
+                overwrite: bool = False) -> None:
+    """
+    Upload many meshes to a cloudvolume at once. This does the same thing as
+    calling push_mesh() on each mesh, but checks for existing meshes and
+    uploads the meshes in batches instead of making separate requests for
+    each mesh, which is much faster when pushing lots of meshes.
+
+    Parameters
+    ----------
+    meshes_and_ids : iterable of (mesh, mesh_id) pairs
+        The meshes to upload and their ids. See push_mesh() for the types
+        of meshes that are accepted.
+
+    vol, scale_by, compress, overwrite
+        See push_mesh().
+    """
+    meshes_and_ids = list(meshes_and_ids)
+    mesh_ids = [mesh_id for _, mesh_id in meshes_and_ids]
 
     if isinstance(vol, str):
-        vol = CloudVolume(vol)
+        vol = _open_cloudvolume(vol)
     if vol.layer_type == 'image':
         try:
-            vol = CloudVolume(vol.cloudpath + '/meshes')
+            vol = _open_cloudvolume(vol.cloudpath + '/meshes')
         except cloudvolume.exceptions.InfoUnavailableError:
             info = CloudVolume.create_new_info(
                 num_channels=vol.num_channels,
@@ -289,25 +890,31 @@ def push_mesh(mesh: Union[str, trimesh.Trimesh, cloudvolume.mesh.Mesh],
 
     assert vol.layer_type == 'segmentation'
     if not overwrite:
-        if vol.mesh.exists([mesh_id], progress=False)[str(mesh_id)]:
-            raise FileExistsError(f'A mesh with id {mesh_id} already exists in'
-                                  f' the volume {vol.cloudpath}. If you want to'
-                                  ' overwrite it, set overwrite=True.')
-
-    if isinstance(mesh, str):
-        mesh = trimesh.load(mesh)
-
-    if hasattr(mesh, 'vertices'):
-        vertices = mesh.vertices
-    elif hasattr(mesh, 'points'):
-        vertices = mesh.points
-    else:
-        raise ValueError('The mesh provided does not have a "vertices"'
-                         ' or "points" attribute.')
-
-    mesh = cloudvolume.mesh.Mesh(
-        vertices * scale_by,
-        mesh.faces,
-        segid=mesh_id
-    )
-    vol.mesh.put(mesh, compress=compress)
+        exists = vol.mesh.exists(mesh_ids, progress=False)
+        existing_ids = [mesh_id for mesh_id in mesh_ids if exists[str(mesh_id)]]
+        if existing_ids:
+            raise FileExistsError(f'Meshes with ids {existing_ids} already exist'
+                                  f' in the volume {vol.cloudpath}. If you want'
+                                  ' to overwrite them, set overwrite=True.')
+
+    cv_meshes = []
+    for mesh, mesh_id in meshes_and_ids:
+        if isinstance(mesh, str):
+            mesh = trimesh.load(mesh)
+
+        if hasattr(mesh, 'vertices'):
+            vertices = mesh.vertices
+        elif hasattr(mesh, 'points'):
+            vertices = mesh.points
+        else:
+            raise ValueError('The mesh provided does not have a "vertices"'
+                             ' or "points" attribute.')
+
+        # Precomputed meshes store vertices as float32, so convert now rather
+        # than carrying float64 copies of every mesh until the upload
+        cv_meshes.append(cloudvolume.mesh.Mesh(
+            np.multiply(vertices, scale_by, dtype=np.float32),
+            mesh.faces,
+            segid=mesh_id
+        ))
+    vol.mesh.put(cv_meshes, compress=compress)
@@ -26,22 +26,24 @@
 # - chunk_size: a list of 3 integers, the size of a chunk in voxels
 # - invert: a boolean, whether to invert black and white in the images
 # - num_mips: an integer, the number of mips (downsamplings of the image) to generate
+# - parallel: an integer, the number of processes to use for uploading chunks
 # If any are not specified, default values will be used. See the default values
 # in the script below.
 
 import sys
 import os
+import re
 import json
 import math
-from glob import glob
-from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures import ThreadPoolExecutor
 
 
 import numpy as np
+import numba
 from cloudvolume import CloudVolume
 from cloudvolume.lib import touch
 import npimage
-import npimage.operations
+import tifffile
 from tqdm import tqdm
 
 import bikinibottom
@@ -53,6 +55,9 @@ import bikinibottom
 # This creates a dataset on your computer, adjacent to the folder
 # containing your tifs
 target_root = 'file://.'
+# Cloud storage paths start with a protocol like gs:// or s3://, while local
+# paths can be given either as file:// paths or as plain paths
+target_is_remote = '://' in target_root and not target_root.startswith('file://')
 
 default_metadata = dict(
     owners=['Your Name <your.email@foo.com>'],
@@ -60,99 +65,384 @@ default_metadata = dict(
                  " Source folder name: {img_folder}"),
     voxel_size_nm=(1, 1, 1),
     encoding='jpeg',
-    chunk_size=(128, 128, 128),
+    # Cloud storage is much faster at transferring a few big chunks than many
+    # small ones, so use larger (several MB once compressed) chunks there
+    chunk_size=(256, 256, 64) if target_is_remote else (128, 128, 128),
     invert=False,
-    num_mips=3
+    num_mips=3,
+    # Number of processes to upload chunks with. Each process also encodes
+    # its chunks (e.g. to jpeg) before uploading them, which is CPU-bound
+    # work, so use every core instead of capping this at the number of
+    # simultaneous uploads worth making.
+    parallel=os.cpu_count()
 )
 
-img_folder = sys.argv[1]
-assert os.path.isdir(img_folder), 'First argument is not a folder'
-img_filenames = glob(f'{img_folder}/*.tif')
-img_filenames.sort()
 
-# Metadata
-if len(sys.argv) > 2:
-    metadata_fn = sys.argv[2]
-    if not os.path.isfile(metadata_fn):
-        raise FileNotFoundError(f'Metadata file not found: {metadata_fn}')
-else:
-    metadata_fn = os.path.join(img_folder, 'metadata.json')
-metadata = default_metadata.copy()
-# Open the metadata file (json format), and update the default metadata with
-# whatever is in the file.
-if not os.path.isfile(metadata_fn):
-    print('WARNING: Default metadata will be used since metadata.json was'
-          ' not found in the data folder.')
-else:
-    with open(metadata_fn, 'r') as f:
-        metadata.update(json.load(f))
-if '{img_folder}' not in metadata['description']:
-    metadata['description'] = metadata['description'] + " Source folder name: {img_folder}"
-print('Metadata:')
-print(json.dumps(metadata, indent=2))
-
-# Determine source data properties
-shape_z = len(img_filenames)
-first_im = npimage.open(img_filenames[0], dim_order='xy')
-shape_x, shape_y = first_im.shape
-shape = (shape_x, shape_y, shape_z)
-source_dtype = first_im.dtype
-
-# Create a new cloudvolume
-info = CloudVolume.create_new_info(
-    num_channels = 1,
-    layer_type = 'image', # 'image' or 'segmentation'
-    data_type = 'uint8', # can pick any popular uint
-    encoding = metadata['encoding'], # other options: 'jpeg', 'compressed_segmentation' (req. uint32 or uint64)
-    resolution = metadata['voxel_size_nm'], # X,Y,Z values in nanometers
-    voxel_offset = [0, 0, 0], # values X,Y,Z values in voxels
-    chunk_size = metadata['chunk_size'], # rechunk of image X,Y,Z in voxels
-    volume_size = shape, # X,Y,Z size in voxels
-)
-target_path = target_root + '/' + img_folder.rstrip('/') + '.' + metadata['encoding'] + '.ng'
-print(f'Opening a cloudvolume at {target_path}')
-vol = CloudVolume(target_path, info=info) #, parallel=8)
-vol.provenance.description = metadata['description'].format(img_folder=img_folder)
-vol.provenance.owners = metadata['owners']
-vol.commit_info() # generates gs://bucket/dataset/info json file
-vol.commit_provenance() # generates gs://bucket/dataset/provenance json
-
-
-# Load image data from a series of tifs
-data = []
-for z, fn in enumerate(tqdm(img_filenames)):
+# Load image data from a series of tifs. Decoding tifs releases the GIL, so
+# many tifs can be read at once by a pool of threads.
+def load_tif(fn):
     if not os.path.isfile(fn):
         print(f'WARNING: File not found: {fn}')
-        data.append(np.zeros((shape_x, shape_y), dtype=source_dtype))
-        continue
-    data.append(npimage.open(fn, dim_order='xy'))
-data = np.stack(data, axis=2)
-data = data[:, :, :, None] # Add a channel dimension
-if data.dtype == np.uint16:
-    print('Converting from uint16 to uint8')
-    # If clip_range is not specified, npimage.operations.to_8bit will
-    # by default use the 0.05th percentile and the 99.95th percentile, which
-    # is reasonable
-    clip_range = metadata.get('8bit_range', [None, None])
-    if clip_range[0] is not None or clip_range[1] is not None:
-        print(f'Using clip range: {clip_range}')
+        return None
+    return npimage.open(fn, dim_order='xy')
+
+
+def natural_sort_key(name):
+    """
+    Sort key that orders numbers within names by value, so that e.g.
+    'slice_2.tif' comes before 'slice_10.tif'.
+    """
+    return [int(part) if part.isdigit() else part
+            for part in re.split(r'(\d+)', name)]
+
+
+def tif_stack_reader(tif):
+    """
+    Get a function read_pages(z0, z1) that reads z slices [z0:z1] of the z
+    stack in the open tifffile.TiffFile tif, as a (z, y, x) array.
+
+    The slices are located through the tif's first series, not its list of
+    pages, since ImageJ stacks bigger than 4 GB only record their first page
+    and describe the rest in their ImageJ metadata. Stacks like those, whose
+    pages are stored uncompressed one after another, are memory mapped, so
+    reading a slab reads only its pages. Other stacks are read page by page
+    from the same open file, without re-walking the file's list of pages.
+    """
+    series = tif.series[0]
+    dtype = series.dtype.newbyteorder('=')
+    if series.dataoffset is not None:
+        stack = np.memmap(tif.filehandle.path, mode='r',
+                          dtype=series.dtype.newbyteorder(tif.byteorder),
+                          offset=series.dataoffset, shape=series.shape)
+
+        def read_pages(z0, z1):
+            # Only big-endian data actually gets copied here, to swap its bytes
+            return np.asarray(stack[z0:z1], dtype=dtype)
+    else:
+        def read_pages(z0, z1):
+            # tifffile decodes the pages in parallel
+            pages = tif.asarray(key=range(z0, z1), series=0)
+            return pages.reshape((z1 - z0,) + series.shape[1:])
+    return read_pages
+
+
+def load_slab(executor, z0, z1, img_filenames, shape, dtype, read_pages=None,
+              lut=None):
+    """
+    Load z slices [z0:z1] of the stack into a 4D (x, y, z, channel) array.
+    The slices come from img_filenames (one tif per slice), or from
+    read_pages(z0, z1) if it is given (see tif_stack_reader).
+
+    If a lookup table lut is given, every value v in the stack is replaced by
+    lut[v]. Each slice is converted as soon as it's read, while it's still in
+    cache, so the unconverted stack is never stored in the slab and never
+    needs a second pass over memory.
+    """
+    if lut is not None:
+        dtype = lut.dtype
+    # Every slice gets written below, so there's no need to spend a pass
+    # over memory zeroing out the slab first. Fortran order makes each z
+    # slice a contiguous block of memory, so writing a slice is a single
+    # sequential copy, and it's also the order CloudVolume uploads from.
+    slab = np.empty((shape[0], shape[1], z1 - z0, 1), dtype=dtype, order='F')  # Last axis is channels
+    if read_pages is not None:
+        # Pages come back as (z, y, x), so reverse the axes to get (x, y, z)
+        pages = read_pages(z0, z1).transpose(2, 1, 0)
+        if lut is None:
+            slab[:, :, :, 0] = pages
+        else:
+            # Convert the pages on the pool's threads, a page per thread
+            list(executor.map(
+                lambda z: apply_lut(pages[:, :, z], lut, slab[:, :, z, 0]),
+                range(z1 - z0)
+            ))
+        return slab
+
+    def load_slice(z):
+        im = load_tif(img_filenames[z0 + z])
+        if im is None:
+            slab[:, :, z, 0] = 0 if lut is None else lut[0]
+        elif lut is None:
+            slab[:, :, z, 0] = im
+        else:
+            apply_lut(im, lut, slab[:, :, z, 0])
+
+    # Each slice gets decoded and converted by one of the pool's threads.
+    # Consuming the results re-raises any exception from those threads.
+    list(executor.map(load_slice, range(z1 - z0)))
+    return slab
+
+
+def iter_slabs(executor, slabs, *args, **kwargs):
+    """
+    Yield each slab (z0, z1) in slabs, loaded by load_slab(executor, z0, z1,
+    *args, **kwargs). The next slab gets loaded in the background while the
+    caller works on the current one, so reading (disk and CPU) overlaps with
+    whatever the caller does with each slab (e.g. uploading it). Only one
+    slab is loaded ahead, so at most two slabs are in memory at once.
+    """
+    with ThreadPoolExecutor(max_workers=1) as prefetcher:
+        next_slab = prefetcher.submit(load_slab, executor, *slabs[0], *args, **kwargs)
+        for i in range(len(slabs)):
+            slab = next_slab.result()
+            if i + 1 < len(slabs):
+                next_slab = prefetcher.submit(load_slab, executor, *slabs[i + 1],
+                                              *args, **kwargs)
+            yield slab
+
+
+# Slices get converted on loading threads, so this kernel is serial and
+# releases the GIL, and the threads convert several slices at once instead.
+# numba's parallel kernels must only be run from the main thread: under its
+# workqueue threading layer, two threads starting parallel kernels at once
+# abort the process, and under its TBB layer, a parallel kernel started from
+# another thread makes the process hang when it exits.
+@numba.njit(nogil=True, cache=True)
+def _apply_lut(data, lut, out):
+    for i in range(data.size):
+        out[i] = lut[data[i]]
+
+
+def apply_lut(data, lut, out):
+    """
+    Fill out with lut[data], i.e. replace each value in data by the entry of
+    the lookup table lut that it indexes. out must be a Fortran-contiguous
+    array with the same shape as data.
+    """
+    # The kernel doesn't check bounds, so anything that would make it index
+    # outside of its arrays has to be caught here
+    if data.shape != out.shape:
+        raise ValueError(f'Expected data to have shape {out.shape}, but it'
+                         f' had shape {data.shape}.')
+    if data.dtype.kind != 'u' or 2 ** (8 * data.dtype.itemsize) > len(lut):
+        raise TypeError(f'A lookup table with {len(lut)} entries can\'t be'
+                        f' applied to data with dtype {data.dtype}.')
+    # The kernel works on flat views, so both arrays must be flattened in
+    # the same memory order
+    data = np.asfortranarray(data)
+    _apply_lut(data.reshape(-1, order='F'), lut, out.reshape(-1, order='F'))
+
+
+def to_8bit_lut(bottom_value, top_value, invert=False):
+    """
+    Make a lookup table for converting uint16 values to uint8, linearly
+    mapping bottom_value to 0 and top_value to 255 and clipping values
+    outside that range, with black and white optionally inverted.
+
+    There are only 65536 possible uint16 values, so the mapping (inversion
+    included) is computed once for each of them, and converting the data is
+    then a single pass of table lookups, with no per-voxel arithmetic. The
+    64 KB table stays in cache throughout.
+    """
+    # (65535 - 0) * 255 is well within int32's range, so there's no need
+    # for the table's arithmetic to be done in int64
+    values = np.arange(65536, dtype=np.int32)
+    span = max(1, top_value - bottom_value)
+    lut = np.clip((values - bottom_value) * 255 // span, 0, 255).astype(np.uint8)
+    if invert:
+        lut ^= 255
+    return lut
+
+
+def percentile_from_histogram(histogram, percentile):
+    """
+    Get the given percentile (0-100) of a set of integers from a histogram
+    of it, where histogram[i] is the number of times that i appears.
+    """
+    cumulative_counts = np.cumsum(histogram)
+    return int(np.searchsorted(cumulative_counts,
+                               percentile / 100 * cumulative_counts[-1]))
+
+
+def main():
+    img_folder = sys.argv[1]
+    assert os.path.isdir(img_folder), 'First argument is not a folder'
+    # Hidden files (like the '._' files macOS leaves behind) aren't images
+    img_filenames = [entry.path for entry in os.scandir(img_folder)
+                     if entry.name.endswith('.tif')
+                     and not entry.name.startswith('.')]
+    img_filenames.sort(key=lambda path: natural_sort_key(os.path.basename(path)))
+
+    # Metadata
+    if len(sys.argv) > 2:
+        metadata_fn = sys.argv[2]
+        if not os.path.isfile(metadata_fn):
+            raise FileNotFoundError(f'Metadata file not found: {metadata_fn}')
+    else:
+        metadata_fn = os.path.join(img_folder, 'metadata.json')
+    metadata = default_metadata.copy()
+    # Open the metadata file (json format), and update the default metadata with
+    # whatever is in the file.
+    if not os.path.isfile(metadata_fn):
+        print('WARNING: Default metadata will be used since metadata.json was'
+              ' not found in the data folder.')
     else:
-        print('Using default clip range (0.05th and 99.95th percentiles)')
-    data = npimage.operations.to_8bit(data,
-                                      bottom_value=clip_range[0],
-                                      top_value=clip_range[1])
-if not data.dtype == np.uint8:
-    raise ValueError(f'Expected data to be uint8, but it was {data.dtype}')
-
-if metadata.get('invert', False):
-    print('Inverting black and white')
-    data = 255 - data
-
-
-# Upload the data to the cloudvolume
-print('Uploading data to cloudvolume')
-vol[:] = data[:]
-# Generate downsampling levels if requested
-for mip in range(metadata['num_mips']):
-    print(f'Downsampling to mip {mip+1} of {metadata["num_mips"]}')
-    data = bikinibottom.downsample_cloudvolume(vol, data=data, return_downsampled_data=True)
+        with open(metadata_fn, 'r') as f:
+            metadata.update(json.load(f))
+    if '{img_folder}' not in metadata['description']:
+        metadata['description'] = metadata['description'] + " Source folder name: {img_folder}"
+    print('Metadata:')
+    print(json.dumps(metadata, indent=2))
+
+    # Determine source data properties
+    # A folder containing a single multi-page tif (e.g. an ImageJ or OME
+    # stack) is treated as the whole z stack, with one page per z slice.
+    # Pages are then read a slab at a time from that one file, which is kept
+    # open, instead of opening one file per slice.
+    stack_tif = None
+    read_pages = None
+    if len(img_filenames) == 1:
+        stack_tif = tifffile.TiffFile(img_filenames[0])
+        series = stack_tif.series[0]
+        if len(series.shape) > 2:
+            # Only grayscale z stacks are supported, not stacks with
+            # channels, color samples or timepoints. A plain multi-page tif
+            # doesn't say what its pages are, so tifffile labels that axis
+            # Q or I instead of Z.
+            if series.axes not in ('ZYX', 'QYX', 'IYX'):
+                raise ValueError('Expected the tif to be a z stack of'
+                                 ' grayscale images (axes ZYX), but its'
+                                 f' axes were {series.axes}')
+            read_pages = tif_stack_reader(stack_tif)
+            shape_z, shape_y, shape_x = series.shape
+            source_dtype = series.dtype.newbyteorder('=')
+        else:
+            stack_tif.close()
+            stack_tif = None
+    if read_pages is None:
+        shape_z = len(img_filenames)
+        first_im = npimage.open(img_filenames[0], dim_order='xy')
+        shape_x, shape_y = first_im.shape
+        source_dtype = first_im.dtype
+    shape = (shape_x, shape_y, shape_z)
+
+    if source_dtype not in (np.uint8, np.uint16):
+        raise ValueError(f'Expected data to be uint8 or uint16, but it was {source_dtype}')
+
+    # Create a new cloudvolume
+    info = CloudVolume.create_new_info(
+        num_channels = 1,
+        layer_type = 'image', # 'image' or 'segmentation'
+        data_type = 'uint8', # can pick any popular uint
+        encoding = metadata['encoding'], # other options: 'jpeg', 'compressed_segmentation' (req. uint32 or uint64)
+        resolution = metadata['voxel_size_nm'], # X,Y,Z values in nanometers
+        voxel_offset = [0, 0, 0], # values X,Y,Z values in voxels
+        chunk_size = metadata['chunk_size'], # rechunk of image X,Y,Z in voxels
+        volume_size = shape, # X,Y,Z size in voxels
+    )
+    target_path = target_root + '/' + img_folder.rstrip('/') + '.' + metadata['encoding'] + '.ng'
+    print(f'Opening a cloudvolume at {target_path}')
+    vol = CloudVolume(target_path, info=info, parallel=metadata['parallel'])
+    vol.provenance.description = metadata['description'].format(img_folder=img_folder)
+    vol.provenance.owners = metadata['owners']
+    vol.commit_info() # generates gs://bucket/dataset/info json file
+    vol.commit_provenance() # generates gs://bucket/dataset/provenance json
+
+    # The stack is loaded, converted and uploaded one chunk-thick slab of z
+    # slices at a time, so only one slab ever needs to be in memory (instead of
+    # the whole stack) and uploading can start as soon as the first slab is read.
+    slab_thickness = metadata['chunk_size'][2]
+    # Mip 1 is made from each slab as it's uploaded, which only works if no
+    # 2x2x2 block straddles two slabs. Two chunks are still chunk-aligned.
+    if slab_thickness % 2 == 1:
+        slab_thickness *= 2
+    slabs = [(z0, min(z0 + slab_thickness, shape_z))
+             for z0 in range(0, shape_z, slab_thickness)]
+
+    with ThreadPoolExecutor(max_workers=os.cpu_count()) as executor:
+        if source_dtype == np.uint16:
+            print('Converting from uint16 to uint8')
+            # If clip_range is not specified, use the 0.05th percentile and the
+            # 99.95th percentile of the whole stack, which is reasonable (and is
+            # what npimage.operations.to_8bit would use)
+            clip_range = metadata.get('8bit_range', [None, None])
+            if clip_range[0] is not None or clip_range[1] is not None:
+                print(f'Using clip range: {clip_range}')
+            else:
+                print('Using default clip range (0.05th and 99.95th percentiles)')
+            if clip_range[0] is None or clip_range[1] is None:
+                # Percentiles of the whole stack can't be known until every slab
+                # has been seen, so make a first pass over the tifs to build a
+                # histogram of the whole stack, which the percentiles come from.
+                print('Computing histogram of pixel values')
+                histogram = np.zeros(65536, dtype=np.int64)
+                for slab in tqdm(iter_slabs(executor, slabs, img_filenames, shape,
+                                            source_dtype, read_pages),
+                                 total=len(slabs)):
+                    # np.bincount is a single linear pass, much faster than
+                    # np.histogram's binning. It converts its input to int64, so
+                    # count one z slice at a time to keep that copy small.
+                    for z in range(slab.shape[2]):
+                        histogram += np.bincount(slab[:, :, z, 0].ravel(order='K'),
+                                                 minlength=65536)
+                clip_range = list(clip_range)
+                if clip_range[0] is None:
+                    clip_range[0] = percentile_from_histogram(histogram, 0.05)
+                if clip_range[1] is None:
+                    clip_range[1] = percentile_from_histogram(histogram, 99.95)
+                print(f'Computed clip range: {clip_range}')
+
+        invert = metadata.get('invert', False)
+        if invert:
+            print('Inverting black and white')
+
+        # Converting to uint8 and inverting are both done through one lookup
+        # table, applied to each slice as it's loaded
+        if source_dtype == np.uint16:
+            lut = to_8bit_lut(clip_range[0], clip_range[1], invert)
+        elif invert:
+            lut = np.arange(255, -1, -1, dtype=np.uint8)
+        else:
+            lut = None
+
+        # Mip 1 is made from each slab of the original data as it's uploaded,
+        # and kept in memory (it's 1/8 the size of the stack). Otherwise it
+        # would be made from mip 0 downloaded and decoded back from the
+        # cloudvolume, picking up its compression artifacts.
+        num_mips = metadata['num_mips']
+        if num_mips > 0:
+            mip1_shape = tuple((n + 1) // 2 for n in shape) + (1,)
+            mip1 = np.empty(mip1_shape, dtype=np.uint8, order='F')
+
+        # Upload the data to the cloudvolume
+        print('Uploading data to cloudvolume')
+        # Uploading stays on the main thread, since CloudVolume's parallel
+        # uploads install signal handlers, which only the main thread can do
+        slab_iter = iter_slabs(executor, slabs, img_filenames, shape,
+                               source_dtype, read_pages, lut=lut)
+        for (z0, z1), slab in tqdm(zip(slabs, slab_iter), total=len(slabs)):
+            # Slabs start on chunk boundaries in z and span the full x and y
+            # extent, so CloudVolume can cut them straight into chunks and
+            # hand those to its 'parallel' upload processes, without having
+            # to download and merge any partially covered chunks first.
+            vol[:, :, z0:z1] = slab
+            if num_mips > 0:
+                # This runs a numba parallel kernel, so like all of them it
+                # stays on the main thread (see _apply_lut)
+                mip1[:, :, z0 // 2:(z1 + 1) // 2] = bikinibottom.downsample_array(slab)
+    if stack_tif is not None:
+        stack_tif.close()
+
+    # Generate downsampling levels if requested. Mip 1 was already made from
+    # the original data above, so upload it, and then make each further mip
+    # from the one before it. Each new mip is kept in memory (it's 1/8 the
+    # size of the mip it came from) to make the next one, so no mip ever
+    # gets downloaded back from the cloudvolume.
+    if num_mips > 0:
+        print(f'Uploading mip 1 of {num_mips}')
+        vol.add_scale((2, 2, 2), chunk_size=vol.chunk_size)
+        vol.commit_info()
+        vol.mip = 1
+        vol[:] = mip1
+        vol.mip = 0
+        data = mip1
+    for mip in range(1, num_mips):
+        print(f'Downsampling to mip {mip+1} of {num_mips}')
+        data = bikinibottom.downsample_cloudvolume(
+            vol, data=data,
+            return_downsampled_data=(mip + 1 < num_mips)
+        )
+
+
+if __name__ == '__main__':
+    main()